@@ -1,20 +1,21 @@
 import numpy as np
 import pandas as pd
-import math
 from skimage.transform import hough_line, hough_line_peaks
 
 from aicssegmentation.core.vessel import filament_3d_wrapper
 from aicssegmentation.core.pre_processing_utils import intensity_normalization, edge_preserving_smoothing_3d, image_smoothing_gaussian_3d
-from skimage.morphology import remove_small_objects, disk, dilation
+from skimage.morphology import remove_small_objects
 from skimage import draw
-from skimage.draw import polygon, polygon2mask
+from skimage.draw import polygon
 from skimage.transform import probabilistic_hough_line
 from skimage.measure import profile_line
-from skimage.morphology import erosion, binary_erosion, binary_dilation, opening, closing, disk, skeletonize
-from skimage.segmentation import expand_labels
+from skimage.morphology import skeletonize
 from skimage.filters import meijering
-from sklearn.cluster import KMeans
-from scipy.spatial import distance_matrix
+from scipy.spatial import cKDTree
+from scipy.ndimage import distance_transform_edt, find_objects
+
+# angles tested by the Hough transform in find_fibers_orientation (computed once)
+_HOUGH_ANGLES = np.linspace(-np.pi / 2, np.pi / 2, 360, endpoint=False)
 
 ################################################################################################################################
 
@@ -28,32 +29,30 @@ def create_mask_from_shapes(vertices_polygons, im_shape):
     - vertices_polygons - list of polygons (coordinates of vertices)
     - im_shape - size of the image to create
     Output:
-    - label image of polygons
+    - label image of polygons with regions of overlap marked as 255 (uint16)
+    - label image of polygons without regions of overlap (uint16)
+    Polygon i gets label i+1, but label 255 is skipped (polygons from the 255th on get i+2).
     '''
 
-    # create a mask out of vertices
-    mask = np.zeros(im_shape).astype('uint8')
+    # keep the label of the last polygon and mark separately pixels covered more than once
+    label_mask = np.zeros(im_shape, dtype='uint16')
+    overlap = np.zeros(im_shape, dtype=bool)
 
     for i,poly in enumerate(vertices_polygons):
 
-        # if drawing was in 3D
-        if len(poly.shape) > 2:
-            mask_coord = polygon(vertices_polygons[i][:,1],vertices_polygons[i][:,2],shape=im_shape)
-        else:
-            #mask_coord = polygon(vertices_polygons[i][:,0],vertices_polygons[i][:,1],shape=im_shape)
-            mask_single = polygon2mask(im_shape,vertices_polygons[i])
+        # last two columns are rows and columns (also if drawing was in 3D)
+        rr,cc = polygon(poly[:,-2],poly[:,-1],shape=im_shape)
 
-        # it's iteratively adding, so regions with anly overlap will be higher than i+1
-        mask[mask_single] = mask[mask_single] + (i+1)
+        overlap[rr,cc] |= (label_mask[rr,cc] != 0)
 
-        # mark areas of the overlap
-        mask[mask > (i+1)] = 255
+        # 255 is reserved for marking the overlap
+        label_mask[rr,cc] = i+1 if i+1 < 255 else i+2
 
-    mask_shapes_overlap = mask
+    # mark areas of the overlap
+    mask_shapes_overlap = np.where(overlap, 255, label_mask).astype('uint16')
 
     # shapes without overlapping regions
-    mask_shapes = mask_shapes_overlap.copy()
-    mask_shapes[mask_shapes == 255] = 0
+    mask_shapes = np.where(overlap, 0, label_mask).astype('uint16')
 
     return mask_shapes_overlap,mask_shapes
 
@@ -105,8 +104,10 @@ def find_fibers_orientation(image_actin_mask_2D):
     dominant_flow - angle (radians) 
     '''
 
-    tested_angles = np.linspace(-np.pi / 2, np.pi / 2, 360, endpoint=False)
-    h, theta, d = hough_line(image_actin_mask_2D, theta=tested_angles)
+    # only foreground pixels vote, so a contiguous boolean mask is enough
+    image_actin_mask_2D = np.ascontiguousarray(image_actin_mask_2D, dtype=bool)
+
+    h, theta, d = hough_line(image_actin_mask_2D, theta=_HOUGH_ANGLES)
 
     _, angle_array, dist_array = hough_line_peaks(h, theta, d)
 
@@ -138,23 +139,20 @@ def calculate_orientation(point1, point2):
 
 def find_fibers_orientation_v2(actin_im):
 
-    skeleton_im = meijering(actin_im,sigmas=range(1, 3),black_ridges=False)
-    skeleton_im[skeleton_im < 0.5] = 0
+    skeleton_im = meijering(actin_im,sigmas=(1, 2),black_ridges=False)
+
+    # only ridges above the threshold vote, so a contiguous boolean mask is enough
+    skeleton_mask = np.ascontiguousarray(skeleton_im >= 0.5)
 
     # find straight lines in the image
-    lines = probabilistic_hough_line(skeleton_im, threshold=1, line_length=15,
+    lines = probabilistic_hough_line(skeleton_mask, threshold=1, line_length=15,
                                     line_gap=0)
 
-    # calculate orientation of the lines
-    rad_list = []
-    for line in lines:
-
-        p0, p1 = line
-        #p0 = [p0[1],p0[0]]
-        #p1 = [p1[1],p1[0]]
-        actin_rad = calculate_orientation(p1,p0)
-
-        rad_list.append(actin_rad)
+    # calculate orientation of the lines (same as calculate_orientation(p1,p0) for every line)
+    line_array = np.asarray(lines,dtype=np.int32).reshape(-1,2,2)
+    dx = line_array[:,0,0] - line_array[:,1,0]
+    dy = line_array[:,0,1] - line_array[:,1,1]
+    rad_list = np.arctan2(dy,dx).tolist()
 
     return lines,rad_list
 
@@ -166,28 +164,17 @@ def orientations_from_vertices(vert):
     It accepts vertices in the format given by Napari
     '''
 
-    my_rad_list = []
-
-    for i in range(len(vert)):
+    # every vertex is paired with the next one (the last one with the first one)
+    vert = np.asarray(vert)
+    vert_next = np.roll(vert,-1,axis=0)
 
-        p0 = vert[i,:]
-        
-        if i == (len(vert)-1):
-            p1 = vert[0,:]
-        else:
-            p1= vert[i+1,:]
-
-        # change of the coordinates to match orientation calculated for actin fibers
-        p0 = [p0[1],p0[0]]
-        p1 = [p1[1],p1[0]]
-        my_rad = calculate_orientation(p1,p0)
+    # rows and columns are swapped to match orientation calculated for actin fibers
+    my_rad = np.arctan2(vert[:,0]-vert_next[:,0],vert[:,1]-vert_next[:,1])
 
-        # old version
-        # my_rad = -(calculate_orientation(p1,p0) % np.pi - np.pi/2)
+    # old version
+    # my_rad = -(calculate_orientation(p1,p0) % np.pi - np.pi/2)
 
-        my_rad_list.append(my_rad)
-
-    return my_rad_list
+    return my_rad.tolist()
 
 ################################################################################################################################
 
@@ -200,14 +187,8 @@ def signal_from_vertices(vert,signal_im,line_width=1,**kwargs):
 
     signal_line = []
 
-    for i in range(len(vert)):
-
-        p0 = vert[i,:]
-        
-        if i == (len(vert)-1):
-            p1 = vert[0,:]
-        else:
-            p1= vert[i+1,:]
+    # every vertex is paired with the next one (the last one with the first one)
+    for p0,p1 in zip(vert,np.roll(vert,-1,axis=0)):
 
         signal_segment = profile_line(signal_im,p0,p1,line_width,**kwargs)
 
@@ -219,36 +200,34 @@ def signal_from_vertices(vert,signal_im,line_width=1,**kwargs):
 
 def divide_cell_outside_ring(cell_image,cell_center,ring_thickness,segment_number):
 
-    # generate single pixel line inside the desired ring
-    eroded_image_1 = erosion(cell_image,disk(int(ring_thickness)))
-    eroded_image_2 = erosion(eroded_image_1,disk(1))
+    # distance of every pixel of the cell to the background
+    dist = distance_transform_edt(cell_image)
 
-    seed_perim_image = eroded_image_1.astype(int) - eroded_image_2.astype(int)
+    # generate single pixel line inside the desired ring (inner border of the eroded cell)
+    eroded_image = dist > ring_thickness
+    seed_perim_image = eroded_image & ~erode_disk(eroded_image,1)
 
     # calculate seeds for clustering
     t = np.nonzero(seed_perim_image)
     points_array = np.array(t).T
 
-    clustering = KMeans(n_clusters=segment_number).fit(points_array)
-
-    center_point_list = []
-
-    for i in range(segment_number):
+    if len(points_array) < segment_number:
+        raise ValueError(f'Ring has {len(points_array)} seed points, not enough for {segment_number} segments.')
 
-        center_point = np.mean(points_array[clustering.labels_==i,:],axis=0)
-        center_point_list.append(center_point)
+    # seeds form a closed line around the center, so they are sorted by angle (clockwise from most right)
+    # and split into groups of equal size, one group per segment
+    seed_angles = np.arctan2(points_array[:,0]-cell_center[1],points_array[:,1]-cell_center[0]) % (2*np.pi)
+    seed_groups = np.array_split(np.argsort(seed_angles,kind='stable'),segment_number)
 
-    center_point_array = np.array(center_point_list)
+    center_point_array = np.array([np.mean(points_array[group,:],axis=0) for group in seed_groups])
 
     # calculate where points from the ring belong
-    eroded_image = erosion(cell_image,disk(ring_thickness))
-    image_ring = cell_image - eroded_image.astype(int)
+    image_ring = (dist > 0) & (dist <= ring_thickness)
     t = np.nonzero(image_ring)
     points_array = np.array(t).T
 
-    dist_mat = distance_matrix(points_array,center_point_array)
-
-    cluster_identity = np.argmin(dist_mat,axis=1)
+    # assign every point to the closest center (without building the full distance matrix)
+    _,cluster_identity = cKDTree(center_point_array).query(points_array,k=1,workers=-1)
     cluster_identity = np.expand_dims(cluster_identity,axis=1)
 
     # concatenate points position with their cluster identity
@@ -257,23 +236,54 @@ def divide_cell_outside_ring(cell_image,cell_center,ring_thickness,segment_numbe
     ##########################################################################
     # arrange clockwise from most right
 
-    # define centroid array
-    centroid_array = pd.DataFrame([np.mean(points_array[points_array[:,2]==x,:],axis=0) for x in range(segment_number)],columns=['x','y','set'])
-    centroid_array['centroid_angle'] = [np.arctan2(x-cell_center[1],y-cell_center[0]) for x,y in zip(centroid_array.loc[:,'x'],centroid_array.loc[:,'y'])]
+    # define centroids of the segments (centers without any points of the ring are dropped)
+    _,cluster_identity = np.unique(cluster_identity[:,0],return_inverse=True)
+    cluster_counts = np.bincount(cluster_identity)
+    centroid_array = np.stack([np.bincount(cluster_identity,weights=points_array[:,x]) for x in range(2)],axis=1)
+    centroid_array = centroid_array / cluster_counts[:,None]
 
-    # shift to start from the most left region
-    centroid_array.loc[centroid_array.centroid_angle<0,'centroid_angle'] = centroid_array.loc[centroid_array.centroid_angle<0,'centroid_angle'] + 2*np.pi
+    # angles shifted to start from the most right region
+    centroid_angle = np.arctan2(centroid_array[:,0]-cell_center[1],centroid_array[:,1]-cell_center[0]) % (2*np.pi)
 
-    # sort
-    centroid_array = centroid_array.sort_values('centroid_angle',ignore_index=True)
+    # sort and change identity based on the new order
+    order = np.argsort(centroid_angle,kind='stable')
+    new_identity = np.empty_like(order)
+    new_identity[order] = np.arange(len(order))
 
-    # change identity based on the new order
-    points_array[:,2] = [centroid_array.loc[centroid_array.set == x,:].index[0] for x in points_array[:,2]]
+    points_array[:,2] = new_identity[cluster_identity]
 
     return points_array
      
 #################################################################################################################################
 
+def erode_disk(mask,radius):
+
+    '''
+    Binary erosion with disk(radius) calculated from the distance transform, so the cost doesn't depend on the radius.
+    '''
+
+    mask = np.asarray(mask,dtype=bool)
+
+    if mask.all():
+        return mask.copy()
+
+    return distance_transform_edt(mask) > radius
+
+def dilate_disk(mask,radius):
+
+    '''
+    Binary dilation with disk(radius) calculated from the distance transform, so the cost doesn't depend on the radius.
+    '''
+
+    mask = np.asarray(mask,dtype=bool)
+
+    if not mask.any():
+        return mask.copy()
+
+    return distance_transform_edt(~mask) <= radius
+
+#################################################################################################################################
+
 def fill_gaps_between_cells(mask_shapes_overlap):
 
     '''
@@ -289,40 +299,40 @@ def fill_gaps_between_cells(mask_shapes_overlap):
     mask_shapes = mask_shapes_overlap.copy()
     mask_shapes[mask_shapes == 255] = 0
 
-    mask_list_small = []
-    mask_list_big = []
+    # a pixel within 8 px from two cells is always within 10 px from both of them,
+    # so it's enough to count how many cells are within 8 px from every pixel
+    ring_small = 8
+    passages = np.zeros(mask_shapes.shape,dtype='uint16')
 
-    # loop through the objects 
-    for i in range(np.max(mask_shapes)):
+    # loop through the objects, each one within its bounding box extended by the ring
+    for i,obj_slice in enumerate(find_objects(mask_shapes)):
 
-        mask = (mask_shapes == i+1)
+        if obj_slice is None:
+            continue
 
-        mask_dilated_small = binary_dilation(mask,disk(8))
-        mask_dilated_big = binary_dilation(mask,disk(10))
+        obj_slice = tuple(slice(max(s.start-ring_small,0),s.stop+ring_small) for s in obj_slice)
+        outside = (mask_shapes[obj_slice] != i+1)
 
-        mask_list_small.append(mask_dilated_small.astype(int) - mask)
-        mask_list_big.append(mask_dilated_big.astype(int) - mask)
+        # distance of every pixel to the cell
+        dist = distance_transform_edt(outside)
 
-
-    # combine the masks (choose regions that may contain corrections)
-    possible = np.sum(np.array(mask_list_big),axis=0)>1
-
-    # select which regions from the small rings are in the possible territory
-    # keeps regions in small distance to a cell not further than the bigger distance from another cell
-    t = np.logical_and(np.array(mask_list_small),possible)
-    passages = np.sum(np.array(t),axis=0)
+        passages[obj_slice] += (dist <= ring_small) & outside
 
     # trim the passages
     mask_to_trim = ((mask_shapes_overlap > 0) | (passages > 1))
-    mask_trimmed = ((opening(mask_to_trim,disk(10))) | (mask_shapes_overlap)>0)
-    mask_trimmed = ((binary_erosion(mask_trimmed,disk(5))) | (mask_shapes_overlap)>0)
-    mask_trimmed = ((closing(mask_trimmed,disk(2))) | (mask_shapes_overlap)>0)
+    mask_trimmed = (dilate_disk(erode_disk(mask_to_trim,10),10) | (mask_shapes_overlap > 0))
+    mask_trimmed = (erode_disk(mask_trimmed,5) | (mask_shapes_overlap > 0))
+    mask_trimmed = (erode_disk(dilate_disk(mask_trimmed,2),2) | (mask_shapes_overlap > 0))
 
     # combine the pixels that need to be re-assigned
     to_divide = mask_trimmed.astype(int) - (mask_shapes_overlap > 0).astype(int) + (mask_shapes_overlap==255).astype(int)
 
-    # re-assign pixels
-    im_divided = expand_labels(mask_shapes,250)*(to_divide).astype(int)
+    # re-assign pixels to the nearest cell (not further than 250 px), only where it's needed
+    dist,(ind_r,ind_c) = distance_transform_edt(mask_shapes == 0,return_indices=True)
+    selected = (to_divide > 0) & (dist <= 250)
+
+    im_divided = np.zeros(mask_shapes.shape,dtype=int)
+    im_divided[selected] = mask_shapes[ind_r[selected],ind_c[selected]]
 
     return im_divided
 
@@ -341,18 +351,12 @@ def calculate_perpendicular_index(angle_actin,angle_membrane):
 
 def calculate_perpendicular_index(alpha, beta):
 
-    # Calculate the angle between lines
-    angle_between_lines = abs(alpha - beta)
-    
-    # Get values between 0 and pi
-    if angle_between_lines > math.pi:
-        angle_between_lines = angle_between_lines - math.pi
-
-    # Get values between 0 and pi/2
-    if angle_between_lines > (math.pi/2):
-        angle_between_lines = math.pi/2 - (angle_between_lines - math.pi/2)
+    # Calculate the angle between lines (values between 0 and pi)
+    # works the same for scalars and arrays of angles
+    angle_between_lines = np.mod(np.subtract(alpha, beta), np.pi)
 
-    M = angle_between_lines/(math.pi/2)
+    # Fold values between 0 and pi/2 (0 - parallel, 1 - perpendicular)
+    M = 1.0 - np.abs(angle_between_lines/(np.pi/2) - 1.0)
 
     return M
 
@@ -418,6 +422,47 @@ def sk_line_profile_coordinates(src, dst, linewidth=1):
     return np.stack([perp_rows, perp_cols])
 
 
+#################################################################################################################################
+def polygon_profile_coordinates(vert, linewidth=1):
+
+    '''
+    Returns coordinates of profiles along all edges of a polygon (the last vertex is connected with the first one).
+    Equivalent to concatenating sk_line_profile_coordinates of every edge, but computed for all edges at once.
+
+    Input:
+    - vert - vertices of the polygon
+    - linewidth - width of the scan, perpendicular to the edges
+    Output:
+    - coords - array of shape (2, N, linewidth), N is the sum of lengths of the profiles
+    '''
+
+    src = np.asarray(vert, dtype=float)
+    dst = np.roll(src, -1, axis=0)
+    d = dst - src
+    theta = np.arctan2(d[:, 0], d[:, 1])
+
+    # the last point of every edge is included in its profile
+    lengths = np.ceil(np.hypot(d[:, 0], d[:, 1]) + 1).astype(int)
+
+    # position of every point along its edge (same arithmetic as np.linspace)
+    edge = np.repeat(np.arange(len(src)), lengths)
+    k = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    step = d / np.maximum(lengths - 1, 1)[:, None]
+    line = k[:, None] * step[edge] + src[edge]
+    is_last = (k == lengths[edge] - 1)
+    line[is_last] = dst[edge[is_last]]
+
+    # perpendicular offsets (from pixel-counting to distances between pixel centers)
+    width = (linewidth - 1) * np.stack([np.cos(theta), np.sin(-theta)], axis=1) / 2
+    perp_start = line - width[edge]
+    perp_stop = line + width[edge]
+    perp_step = (perp_stop - perp_start) / max(linewidth - 1, 1)
+    coords = np.arange(linewidth)[None, :, None] * perp_step[:, None, :] + perp_start[:, None, :]
+    coords[:, -1, :] = perp_stop
+
+    return np.moveaxis(coords, 2, 0)
+
+
 #################################################################################################################################
 def get_internal_points(vert,line_width=3):
 
@@ -431,46 +476,30 @@ def get_internal_points(vert,line_width=3):
     if line_width < 3:
         return 'Error - line width has to be at least 3.'
 
-    coord_line_x = []
-    coord_line_y = []
-
-    for i in range(len(vert)):
-
-        p0 = vert[i,:]
-        
-        if i == (len(vert)-1):
-            p1 = vert[0,:]
-        else:
-            p1= vert[i+1,:]
-
-
-        signal_segment = sk_line_profile_coordinates(p0,p1,linewidth=line_width)
-
-        coord_line_x.extend(signal_segment[0])
-        coord_line_y.extend(signal_segment[1])
+    # coordinates along all the edges at once
+    coord_line = polygon_profile_coordinates(vert,linewidth=line_width)
 
     # reshape output
-    t = np.array([coord_line_x,coord_line_y]).T.astype(int)
+    t = coord_line.T.astype(int)
 
     # layers are organized from outside to inside 
     start_including = int(line_width/2)
 
-    df_list = []
-    for i in range(start_including,line_width):
+    layers = t[start_including:line_width]
+    layer_number,point_number = layers.shape[:2]
 
-        layer = t[i,...]
-        l_unique = np.unique(layer.astype(int),axis=0,return_index=True)
+    # mark first occurrence of every point within a layer
+    unique = np.zeros((layer_number,point_number),dtype=bool)
+    for i,layer in enumerate(layers):
 
-        df = pd.DataFrame(layer)
-        df['unique'] = False
-        df['layer'] = i - start_including
-        df['ord'] = df.index
-        df.loc[l_unique[1],'unique'] = True 
+        l_unique = np.unique(layer,axis=0,return_index=True)
+        unique[i,l_unique[1]] = True
 
-        df_list.append(df)
-
-    df_all = pd.concat(df_list,ignore_index = True)
-    df_all.columns = ['r','c','uniqe','layer','ord']
+    df_all = pd.DataFrame({'r':layers[...,0].ravel(),
+                           'c':layers[...,1].ravel(),
+                           'uniqe':unique.ravel(),
+                           'layer':np.repeat(np.arange(layer_number),point_number),
+                           'ord':np.tile(np.arange(point_number),layer_number)})
 
     return df_all
 
@@ -482,10 +511,10 @@ def create_edge_visual(im_size,vertices,orientations,line_width=5):
     Utility to create an image visualizing edge orientation vs main flow of actin in single cells.
     '''
 
-    # prepare image of edge orientation vs actin
-    edge_image = np.zeros(im_size)
+    # prepare image of edges labeled with their index
+    edge_labels = np.zeros(im_size,dtype=np.int32)
 
-    for i,o in zip(range(len(vertices)),orientations):
+    for i in range(min(len(vertices),len(orientations))):
         
         p0 = vertices[i]
 
@@ -495,9 +524,16 @@ def create_edge_visual(im_size,vertices,orientations,line_width=5):
             p1 = vertices[i+1]
 
         rr,cc = draw.line(p0[0],p0[1],p1[0],p1[1])
-        edge_image[rr,cc] = o
+        edge_labels[rr,cc] = i+1
+
+    if not edge_labels.any():
+        return np.zeros(im_size)
 
-    edge_image = dilation(edge_image,disk(line_width))
+    # widen the edges - every pixel takes the orientation of the nearest edge (not further than line_width)
+    dist,(ind_r,ind_c) = distance_transform_edt(edge_labels == 0,return_indices=True)
+    nearest_edge = edge_labels[ind_r,ind_c]
+
+    edge_image = np.where(dist <= line_width,np.asarray(orientations,dtype=float)[nearest_edge-1],0)
 
     return edge_image
 
@@ -506,17 +542,19 @@ def create_edge_visual(im_size,vertices,orientations,line_width=5):
 def interpolate_and_fill(signal):
 
     # where signal is missing
-    x = np.argwhere((np.isnan(signal))).squeeze()
+    missing = np.isnan(signal)
+
+    if not missing.any():
+        return signal
+
+    x = np.flatnonzero(missing)
 
     # existing signal
-    xp = np.argwhere(~(np.isnan(signal))).squeeze()
-    fp = signal[~(np.isnan(signal))].squeeze()
-    
-    # interpolate the values
-    values_interp = np.interp(x,xp,fp)
-    
-    # fill in the values
-    signal[x] = values_interp
+    xp = np.flatnonzero(~missing)
+    fp = signal[xp]
+
+    # interpolate and fill in the values
+    signal[x] = np.interp(x,xp,fp)
 
     return signal
 